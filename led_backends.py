@@ -0,0 +1,501 @@
+"""LED controller backends shared by led_controller.py, led_daemon.py and wyoming_led_service.py."""
+import ctypes
+import logging
+import mmap
+import os
+import struct
+import sys
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+try:
+    import gpiozero
+except ImportError:
+    gpiozero = None
+
+_LOGGER = logging.getLogger(__name__)
+
+# Largest strip the command line tools accept
+MAX_LEDS = 10
+
+# WS2812 over SPI: one SPI byte per data bit, same timings as rpi5-ws2812
+WS2812_SPI_ZERO = 0b11000000
+WS2812_SPI_ONE = 0b11111100
+WS2812_SPI_PREAMBLE = 42
+
+# Reset time a WS2812 needs after the last bit before it latches a frame
+WS2812_LATCH_S = 0.00028
+
+# APA102 LEDs latch data on the clock edge alone and take up to ~20 MHz
+APA102_SPI_HZ = 20000000
+
+# Largest transfer spidev hands to the kernel in one piece
+SPIDEV_BUFSIZ_PATH = '/sys/module/spidev/parameters/bufsiz'
+
+# Chunk size for spidev builds without writebytes2 (its default bufsiz)
+SPIDEV_CHUNK = 4096
+
+# SPI encoding of every possible color byte, MSB first (8 SPI bytes each)
+WS2812_SPI_LUT = tuple(
+    bytes(WS2812_SPI_ONE if value & (0x80 >> bit) else WS2812_SPI_ZERO for bit in range(8))
+    for value in range(256)
+)
+
+# Frames repeat a handful of colors, so recent encodings are kept
+@lru_cache(maxsize=32)
+def encode_ws2812_spi(grb: bytes) -> bytes:
+    """Expand GRB bytes into the SPI bit pattern understood by WS2812 LEDs."""
+    return b''.join(map(WS2812_SPI_LUT.__getitem__, grb))
+
+# The board model and SPI device nodes don't change while the process runs
+@lru_cache(maxsize=1)
+def is_raspberry_pi_5():
+    """Check if we're running on a Raspberry Pi 5."""
+    # Raw fd read: no text wrapper or decoding for a few bytes of model name
+    try:
+        fd = os.open('/proc/device-tree/model', os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        return b'Raspberry Pi 5' in os.read(fd, 64)
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+
+@lru_cache(maxsize=1)
+def is_spi_enabled():
+    """Check if SPI is enabled."""
+    return (os.path.exists('/dev/spidev0.0') or
+            os.path.exists('/dev/spidev1.0') or
+            os.path.exists('/dev/spidev10.0'))
+
+@lru_cache(maxsize=1)
+def get_available_spi_bus():
+    """Find an available SPI bus, prioritizing alternate SPI buses to avoid NVME/PCIe conflicts"""
+    # Check for SPI10 (special case on some Pi configurations)
+    if os.path.exists('/dev/spidev10.0'):
+        return 10
+    # Check for SPI1
+    elif os.path.exists('/dev/spidev1.0'):
+        return 1
+    # Fall back to SPI0 if others not available
+    elif os.path.exists('/dev/spidev0.0'):
+        return 0
+    return None
+
+def check_spidev_bufsiz(frame_len: int):
+    """Warn if spidev would split a frame of frame_len bytes into several transfers."""
+    try:
+        with open(SPIDEV_BUFSIZ_PATH, 'r') as f:
+            bufsiz = int(f.read())
+    except (OSError, ValueError):
+        return
+    if frame_len > bufsiz:
+        _LOGGER.warning(f"SPI frame of {frame_len} bytes exceeds spidev bufsiz ({bufsiz}); "
+                        f"add 'options spidev bufsiz=65536' to /etc/modprobe.d/spidev.conf and reboot")
+
+def spi_writer(spi):
+    """Return a function writing a whole buffer to an open SpiDev."""
+    if hasattr(spi, 'writebytes2'):
+        return spi.writebytes2
+
+    def write_chunks(data):
+        # Older spidev only takes lists of at most bufsiz bytes; memoryview
+        # slices avoid copying the rest of the buffer on every chunk
+        view = memoryview(data)
+        for offset in range(0, len(view), SPIDEV_CHUNK):
+            spi.writebytes(list(view[offset:offset + SPIDEV_CHUNK]))
+    return write_chunks
+
+class LEDController:
+    """Base class for LED controllers."""
+
+    def __init__(self, num_leds: int):
+        self.num_leds = num_leds
+        self.cleaned_up = False
+
+    def set_color(self, led_index: int, r: int, g: int, b: int):
+        """Set a specific LED to a color."""
+        raise NotImplementedError()
+
+    def set_all(self, r: int, g: int, b: int):
+        """Set all LEDs to the same color."""
+        for i in range(self.num_leds):
+            self.set_color(i, r, g, b)
+
+    def set_pattern(self, rgb_values: List[int]):
+        """Set each LED from a flat list of R, G, B values."""
+        raise NotImplementedError()
+
+    def _pattern_bytes(self, rgb_values: List[int]) -> bytes:
+        """Validate a flat R, G, B list and return it as bytes."""
+        if len(rgb_values) != self.num_leds * 3:
+            raise ValueError(f"Expected {self.num_leds * 3} values for {self.num_leds} LEDs, got {len(rgb_values)}.")
+        return bytes(rgb_values)
+
+    def prebuild(self, palette: List[Tuple[int, int, int]]):
+        """Precompute what set_prebuilt() needs for a fixed set of colors."""
+
+    def set_prebuilt(self, rgb: Tuple[int, int, int]):
+        """Set all LEDs to a color, using prebuilt data when there is any."""
+        self.set_all(rgb[0], rgb[1], rgb[2])
+
+    def clear(self):
+        """Turn off all LEDs."""
+        self.set_all(0, 0, 0)
+
+    def close(self):
+        """Release the hardware."""
+
+    def cleanup(self):
+        """Turn off the LEDs and release the hardware, once."""
+        # Signal handlers and finally blocks may both end up here
+        if self.cleaned_up:
+            return
+        self.cleaned_up = True
+        try:
+            self.clear()
+            self.close()
+        except Exception as e:
+            _LOGGER.error(f"Error during cleanup: {e}")
+
+class WS2812LEDController(LEDController):
+    """Base class for WS2812 controllers, which keep the strip's GRB frame in memory."""
+
+    def __init__(self, num_leds: int):
+        super().__init__(num_leds)
+        # Dirty until the first write, as the LEDs may still show whatever a
+        # previous process left on them
+        self.grb = bytearray(3 * num_leds)
+        self.dirty = True
+
+    def set_color(self, led_index: int, r: int, g: int, b: int):
+        if 0 <= led_index < self.num_leds:
+            offset = 3 * led_index
+            grb = bytes((g, r, b))
+            if self.grb[offset:offset + 3] != grb:
+                self.grb[offset:offset + 3] = grb
+                self.dirty = True
+            self.flush()
+
+    def set_all(self, r: int, g: int, b: int):
+        frame = bytes((g, r, b)) * self.num_leds
+        if self.grb != frame:
+            self.grb[:] = frame
+            self.dirty = True
+        self.flush()
+
+    def set_pattern(self, rgb_values: List[int]):
+        rgb = self._pattern_bytes(rgb_values)
+        # Reorder RGB triplets into GRB with strided slices, which run in C
+        frame = bytearray(len(rgb))
+        frame[0::3] = rgb[1::3]
+        frame[1::3] = rgb[0::3]
+        frame[2::3] = rgb[2::3]
+        if self.grb != frame:
+            self.grb[:] = frame
+            self.dirty = True
+        self.flush()
+
+    def flush(self):
+        """Send the frame to the strip if it changed since the last write."""
+        raise NotImplementedError()
+
+class RPI5LEDController(WS2812LEDController):
+    """LED Controller for Raspberry Pi 5 using SPI."""
+
+    def __init__(self, num_leds: int, spi_bus: Optional[int] = None):
+        super().__init__(num_leds)
+        try:
+            # Import SPI libraries inside try block to handle import errors
+            from rpi5_ws2812.ws2812 import WS2812SpiDriver
+
+            # On RPi5, we need to properly initialize SPI
+            import spidev
+
+            # Determine which SPI bus to use
+            if spi_bus is None:
+                self.spi_bus = get_available_spi_bus()
+                if self.spi_bus is None:
+                    raise ValueError("No SPI bus available")
+            else:
+                self.spi_bus = spi_bus
+
+            # Close any existing SPI connections first to prevent resource conflicts
+            try:
+                spi = spidev.SpiDev()
+                spi.open(self.spi_bus, 0)
+                spi.close()
+            except Exception:
+                # If no existing connection, this is fine
+                pass
+
+            # Now initialize our LED driver. It configures the SPI device; frames
+            # are encoded here with the lookup table and written straight to it.
+            _LOGGER.info(f"Using SPI bus {self.spi_bus} for LED control")
+            self.driver = WS2812SpiDriver(spi_bus=self.spi_bus, spi_device=0, led_count=num_leds)
+            self.spi = self.driver._device
+            self.spi_write = spi_writer(self.spi)
+            # Page-aligned wire frame that lives as long as the controller, so
+            # spidev copies each frame out of a single, never-reallocated page
+            self.wire = mmap.mmap(-1, WS2812_SPI_PREAMBLE + 24 * num_leds)
+            self.clear_wire = bytes(WS2812_SPI_PREAMBLE) + encode_ws2812_spi(bytes(3 * num_leds))
+            check_spidev_bufsiz(len(self.wire))
+            _LOGGER.info("Using RPI5-WS2812 driver")
+        except ImportError:
+            _LOGGER.error("rpi5-ws2812 library not found. Install with 'pip install rpi5-ws2812'")
+            sys.exit(1)
+        except Exception as e:
+            _LOGGER.error(f"Error initializing RPI5-WS2812: {e}")
+            sys.exit(1)
+
+    def flush(self):
+        if not self.dirty:
+            return
+        self.wire[WS2812_SPI_PREAMBLE:] = encode_ws2812_spi(bytes(self.grb))
+        self.spi_write(self.wire)
+        self.dirty = False
+
+    def prebuild(self, palette: List[Tuple[int, int, int]]):
+        """Encode the whole-strip frame for each palette color ahead of time."""
+        for r, g, b in palette:
+            encode_ws2812_spi(bytes((g, r, b)) * self.num_leds)
+
+    def clear(self):
+        if not self.dirty and not any(self.grb):
+            return
+        # All-off is a known frame, so send the precomputed wire bytes as-is
+        self.grb[:] = bytes(len(self.grb))
+        self.dirty = True
+        self.spi_write(self.clear_wire)
+        self.dirty = False
+
+    def close(self):
+        if hasattr(self, 'spi'):
+            self.spi.close()
+            self.wire.close()
+            _LOGGER.info("SPI connection closed")
+
+class RPI281xLEDController(WS2812LEDController):
+    """LED Controller for other Raspberry Pi models using the rpi_ws281x library."""
+
+    def __init__(self, num_leds: int, led_pin: int = 18):
+        super().__init__(num_leds)
+        try:
+            from rpi_ws281x import PixelStrip, WS2811_STRIP_GRB
+            LED_PIN = led_pin
+            LED_FREQ_HZ = 800000
+            LED_DMA = 10
+            LED_BRIGHTNESS = 255
+            LED_INVERT = False
+            LED_CHANNEL = 0
+
+            self.strip = PixelStrip(num_leds, LED_PIN, LED_FREQ_HZ, LED_DMA, LED_INVERT,
+                                  LED_BRIGHTNESS, LED_CHANNEL, WS2811_STRIP_GRB)
+            self.strip.begin()
+            self.pixels = self.strip.getPixels()
+            self.led_buffer = self._map_led_buffer(num_leds)
+            _LOGGER.info("Using RPI_WS281x driver")
+        except ImportError:
+            _LOGGER.error("rpi_ws281x library not found. Install with 'pip install rpi_ws281x'")
+            sys.exit(1)
+        except Exception as e:
+            _LOGGER.error(f"Error initializing RPI_WS281x: {e}")
+            sys.exit(1)
+
+    def _map_led_buffer(self, num_leds: int):
+        """Map the channel's LED array with ctypes, or None if the binding doesn't expose it."""
+        try:
+            import _rpi_ws281x as ws
+            # Allocated by begin(), one native uint32 0RGB word per LED
+            address = int(ws.ws2811_channel_t_leds_get(self.strip._channel))
+        except Exception:
+            return None
+        if not address:
+            return None
+        return (ctypes.c_uint32 * num_leds).from_address(address)
+
+    def flush(self):
+        if not self.dirty:
+            return
+        # Pad each GRB triplet to a big-endian 0RGB word, the value Color() packs
+        words = bytearray(4 * self.num_leds)
+        words[1::4] = self.grb[1::3]
+        words[2::4] = self.grb[0::3]
+        words[3::4] = self.grb[2::3]
+        values = struct.unpack(f'>{self.num_leds}I', words)
+        if self.led_buffer is not None:
+            # One copy in C instead of a ws2811_led_set() call per LED
+            self.led_buffer[:] = values
+        else:
+            self.pixels[:self.num_leds] = values
+        self.strip.show()
+        self.dirty = False
+
+class RespeakerLEDController(LEDController):
+    """LED Controller for ReSpeaker 2mic HAT using APA102."""
+
+    # RGB mappings
+    RGB_MAP = {
+        "rgb": [3, 2, 1],
+        "rbg": [3, 1, 2],
+        "grb": [2, 3, 1],
+        "gbr": [2, 1, 3],
+        "brg": [1, 3, 2],
+        "bgr": [1, 2, 3],
+    }
+
+    # APA102 constants
+    MAX_BRIGHTNESS = 0b11111
+    LED_START = 0b11100000
+
+    def __init__(self, num_leds: int, gpio_pin: int = 12, brightness: int = 31,
+                 order: str = "rgb", bus: int = None, device: int = 0, max_speed_hz: int = APA102_SPI_HZ):
+        super().__init__(num_leds)
+
+        # Set up GPIO for LED power
+        if gpiozero:
+            self.led_power = gpiozero.LED(gpio_pin, active_high=False)
+            self.led_power.on()
+        else:
+            _LOGGER.warning("gpiozero not available, LED power control disabled")
+            self.led_power = None
+
+        # Set up RGB order
+        order = order.lower()
+        self.rgb = self.RGB_MAP.get(order, self.RGB_MAP["rgb"])
+
+        # Set brightness
+        if brightness > self.MAX_BRIGHTNESS:
+            self.brightness = self.MAX_BRIGHTNESS
+        else:
+            self.brightness = brightness
+
+        _LOGGER.debug("LED brightness: %d", self.brightness)
+
+        # LED startframe is three "1" bits, followed by 5 brightness bits.
+        # Precomputed for every bright_percent (0-100) that set_color accepts.
+        self.ledstart_by_percent = bytes(
+            (int((percent * self.brightness / 100.0) + 0.5) & 0b00011111) | self.LED_START
+            for percent in range(101)
+        )
+
+        # Whole SPI transfer: 4-byte start frame, LED data, 4-byte end frame.
+        # The pixel buffer is a view into it, so nothing is copied on show().
+        self.frame = bytearray(4 + 4 * self.num_leds + 4)
+        self.frame[-4:] = b'\xff' * 4
+        self.leds = memoryview(self.frame)[4:-4]
+        # Only the start bytes need setting, the colors are already zero
+        self.leds[0::4] = bytes([self.LED_START]) * self.num_leds
+        # Complete frames for fixed colors, see prebuild()
+        self.prebuilt = {}
+        # Last frame sent, unknown until the first show()
+        self.last_frame: Optional[bytes] = None
+
+        try:
+            # Close any existing SPI connections first
+            import spidev
+
+            # Determine which SPI bus to use - default is SPI1 for ReSpeaker
+            if bus is None:
+                # For ReSpeaker, traditionally use SPI1 on older Pis
+                # But on Pi5 with NVME, try to avoid conflicts
+                self.spi_bus = get_available_spi_bus()
+                if self.spi_bus is None:
+                    raise ValueError("No SPI bus available")
+            else:
+                self.spi_bus = bus
+
+            _LOGGER.info(f"Using SPI bus {self.spi_bus} for ReSpeaker")
+
+            try:
+                # Check if there's an existing connection to close
+                temp_spi = spidev.SpiDev()
+                temp_spi.open(self.spi_bus, device)
+                temp_spi.close()
+            except Exception:
+                # If no existing connection, this is fine
+                pass
+
+            # Now open our connection
+            self.spi = spidev.SpiDev()
+            self.spi.open(self.spi_bus, device)
+            if max_speed_hz:
+                self.spi.max_speed_hz = max_speed_hz
+            self.spi_write = spi_writer(self.spi)
+            check_spidev_bufsiz(len(self.frame))
+            _LOGGER.info("Using APA102 driver for ReSpeaker HAT")
+        except ImportError:
+            _LOGGER.error("spidev library not found. Install with 'pip install spidev'")
+            sys.exit(1)
+        except Exception as e:
+            _LOGGER.error(f"Error initializing SPI for ReSpeaker: {e}")
+            sys.exit(1)
+
+    def set_color(self, led_num: int, r: int, g: int, b: int, bright_percent: int = 100):
+        """Set a single LED to a specific color."""
+        if led_num < 0 or led_num >= self.num_leds:
+            return
+
+        start_index = 4 * led_num
+        self.leds[start_index] = self.ledstart_by_percent[bright_percent]
+        self.leds[start_index + self.rgb[0]] = r
+        self.leds[start_index + self.rgb[1]] = g
+        self.leds[start_index + self.rgb[2]] = b
+
+    def show(self):
+        """Send the LED data to the strip, unless it already shows this frame."""
+        if self.frame == self.last_frame:
+            return
+        # One write for start frame, LED data and end frame
+        self.spi_write(self.frame)
+        self.last_frame = bytes(self.frame)
+
+    def set_all(self, r: int, g: int, b: int):
+        """Set all LEDs to the same color."""
+        for i in range(self.num_leds):
+            self.set_color(i, r, g, b)
+        self.show()
+
+    def prebuild(self, palette: List[Tuple[int, int, int]]):
+        """Render the complete SPI frame for each palette color."""
+        ledstart = self.ledstart_by_percent[100]
+        for r, g, b in palette:
+            pixel = bytearray([ledstart, 0, 0, 0])
+            pixel[self.rgb[0]] = r
+            pixel[self.rgb[1]] = g
+            pixel[self.rgb[2]] = b
+            self.prebuilt[(r, g, b)] = bytes(4) + bytes(pixel) * self.num_leds + b'\xff' * 4
+
+    def set_prebuilt(self, rgb: Tuple[int, int, int]):
+        """Set all LEDs to a color, copying its prebuilt frame when there is one."""
+        frame = self.prebuilt.get(tuple(rgb))
+        if frame is None:
+            self.set_all(rgb[0], rgb[1], rgb[2])
+            return
+        self.frame[:] = frame
+        self.show()
+
+    def close(self):
+        if self.led_power:
+            self.led_power.off()
+        if hasattr(self, 'spi'):
+            self.spi.close()
+            _LOGGER.info("SPI connection closed")
+
+def create_led_controller(num_leds: int, gpio_pin: int = 12, brightness: int = 31,
+                         respeaker_mode: bool = False, led_pin: int = 18,
+                         spi_bus: Optional[int] = None, spi_hz: int = APA102_SPI_HZ) -> LEDController:
+    """Factory method to create the appropriate LED controller."""
+
+    if respeaker_mode:
+        _LOGGER.info("Using ReSpeaker HAT LED controller")
+        return RespeakerLEDController(num_leds, gpio_pin, brightness, bus=spi_bus, max_speed_hz=spi_hz)
+
+    if is_raspberry_pi_5() and is_spi_enabled():
+        _LOGGER.info("Detected Raspberry Pi 5 with SPI enabled")
+        return RPI5LEDController(num_leds, spi_bus=spi_bus)
+
+    _LOGGER.info("Using standard WS281x LED controller")
+    return RPI281xLEDController(num_leds, led_pin)
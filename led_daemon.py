@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""Keeps the LEDs open and applies led_controller.py commands sent over a Unix socket."""
+import argparse
+import logging
+import os
+import shlex
+import signal
+import socketserver
+import sys
+import threading
+
+from led_backends import MAX_LEDS, create_led_controller
+from led_controller import add_commands, check_led_count, run_command
+
+DEFAULT_SOCKET = '/run/led.sock'
+
+class CommandParser(argparse.ArgumentParser):
+    """Parser for socket lines that raises ValueError instead of printing and exiting."""
+
+    def _print_message(self, message, file=None):
+        pass
+
+    def exit(self, status=0, message=None):
+        raise ValueError(message or "help is not available over the socket")
+
+    def error(self, message):
+        raise ValueError(message)
+
+# Socket lines carry a command only; the strip options are fixed at startup
+COMMAND_PARSER = CommandParser(prog='led_daemon.py', add_help=False)
+add_commands(COMMAND_PARSER)
+
+class CommandHandler(socketserver.StreamRequestHandler):
+    """Reads one command per line and answers each with 'ok' or an error message."""
+
+    def handle(self):
+        for line in self.rfile:
+            reply = self.server.execute(line.decode(errors='replace').strip())
+            self.wfile.write(reply.encode() + b'\n')
+
+class LEDDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server sharing a single LEDController between all clients."""
+
+    # Each client gets its own thread, so an idle connection can't hold up
+    # the others; these don't keep the daemon from exiting
+    daemon_threads = True
+
+    def __init__(self, socket_path, controller):
+        self.controller = controller
+        self.lock = threading.Lock()
+        # Set under the lock once cleanup starts, so no command runs after it
+        self.shutting_down = False
+        super().__init__(socket_path, CommandHandler)
+
+    def execute(self, line):
+        try:
+            args = COMMAND_PARSER.parse_args(shlex.split(line))
+        except ValueError as e:
+            return f"Error: Invalid command: {line} ({e})"
+
+        try:
+            with self.lock:
+                if self.shutting_down:
+                    return "Error: shutting down"
+                if not run_command(self.controller, args):
+                    return "Error: No command given"
+        except ValueError as e:
+            return f"Error: {e}"
+        except Exception as e:
+            return f"Unexpected error: {e}"
+        return 'ok'
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve WS2812 LED commands on a Unix socket')
+    parser.add_argument('--leds', type=int, default=8, help=f'Number of LEDs to control (1-{MAX_LEDS})')
+    parser.add_argument('--spi-bus', type=int, choices=[0, 1, 10], help='SPI bus to use (0, 1, or 10, default: auto-detect)')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help=f'Unix socket to listen on (default: {DEFAULT_SOCKET})')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    try:
+        check_led_count(args.leds)
+        controller = create_led_controller(args.leds, spi_bus=args.spi_bus)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    # Remove a socket left behind by a previous run
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+    server = LEDDaemon(args.socket, controller)
+
+    def signal_handler(sig, frame):
+        print('Cleaning up...')
+        sys.exit(0)
+
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+
+    print(f"Listening on {args.socket}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+        # Client threads outlive server_close(), so wait for any command in
+        # progress and turn the rest away before touching the hardware
+        with server.lock:
+            server.shutting_down = True
+            controller.cleanup()
+
+if __name__ == '__main__':
+    main()
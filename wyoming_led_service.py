@@ -2,18 +2,13 @@
 """Controls the LEDs via Wyoming events, supporting both ReSpeaker HAT and RPI5 SPI."""
 import argparse
 import asyncio
+import itertools
 import logging
+import queue
 import signal
-import sys
-import time
-import os
+import threading
 from functools import partial
-from typing import Tuple, List, Optional
-
-try:
-    import gpiozero
-except ImportError:
-    gpiozero = None
+from typing import Callable, Dict, Tuple, List, Optional
 
 from wyoming.asr import Transcript
 from wyoming.event import Event
@@ -28,10 +23,11 @@ from wyoming.server import AsyncEventHandler, AsyncServer
 from wyoming.vad import VoiceStarted
 from wyoming.wake import Detection
 
+from led_backends import APA102_SPI_HZ, MAX_LEDS, LEDController, create_led_controller
+
 _LOGGER = logging.getLogger()
 
 # Default settings
-MAX_LEDS = 10
 DEFAULT_LEDS = 3
 
 # Colors
@@ -42,365 +38,142 @@ _YELLOW = (255, 255, 0)
 _BLUE = (0, 0, 255)
 _GREEN = (0, 255, 0)
 
-def is_raspberry_pi_5():
-    """Check if we're running on a Raspberry Pi 5."""
-    try:
-        with open('/proc/device-tree/model', 'r') as f:
-            return 'Raspberry Pi 5' in f.read()
-    except:
-        return False
-
-def is_spi_enabled():
-    """Check if SPI is enabled."""
-    return (os.path.exists('/dev/spidev0.0') or 
-            os.path.exists('/dev/spidev1.0') or 
-            os.path.exists('/dev/spidev10.0'))
-
-def get_available_spi_bus():
-    """Find an available SPI bus, prioritizing alternate SPI buses to avoid NVME/PCIe conflicts"""
-    # Check for SPI10 (special case on some Pi configurations)
-    if os.path.exists('/dev/spidev10.0'):
-        return 10
-    # Check for SPI1
-    elif os.path.exists('/dev/spidev1.0'):
-        return 1
-    # Fall back to SPI0 if others not available
-    elif os.path.exists('/dev/spidev0.0'):
-        return 0
-    return None
-
-class LEDController:
-    """Base class for LED controllers."""
-    
-    def __init__(self, num_leds: int):
-        self.num_leds = num_leds
-        
-    def set_color(self, led_index: int, r: int, g: int, b: int):
-        """Set a specific LED to a color."""
-        raise NotImplementedError()
-        
-    def set_all(self, r: int, g: int, b: int):
-        """Set all LEDs to the same color."""
-        for i in range(self.num_leds):
-            self.set_color(i, r, g, b)
-            
-    def clear(self):
-        """Turn off all LEDs."""
-        self.set_all(0, 0, 0)
-        
-    def cleanup(self):
-        """Clean up resources."""
-        self.clear()
+# Every color the event handler uses
+_PALETTE = (_BLACK, _WHITE, _RED, _YELLOW, _BLUE, _GREEN)
 
-class RPI5LEDController(LEDController):
-    """LED Controller for Raspberry Pi 5 using SPI."""
-    
-    def __init__(self, num_leds: int, spi_bus: Optional[int] = None):
-        super().__init__(num_leds)
-        try:
-            # Import SPI libraries inside try block to handle import errors
-            from rpi5_ws2812.ws2812 import Color, WS2812SpiDriver
-            self.color_class = Color
-            
-            # On RPi5, we need to properly initialize SPI
-            import spidev
-            
-            # Determine which SPI bus to use
-            if spi_bus is None:
-                self.spi_bus = get_available_spi_bus()
-                if self.spi_bus is None:
-                    raise ValueError("No SPI bus available")
-            else:
-                self.spi_bus = spi_bus
-                
-            # Close any existing SPI connections first to prevent resource conflicts
-            try:
-                spi = spidev.SpiDev()
-                spi.open(self.spi_bus, 0)
-                spi.close()
-            except Exception:
-                # If no existing connection, this is fine
-                pass
-                
-            # Now initialize our LED driver
-            _LOGGER.info(f"Using SPI bus {self.spi_bus} for LED control")
-            self.strip = WS2812SpiDriver(spi_bus=self.spi_bus, spi_device=0, led_count=num_leds).get_strip()
-            self.led_states = [self.color_class(0, 0, 0)] * self.num_leds
-            _LOGGER.info("Using RPI5-WS2812 driver")
-        except ImportError:
-            _LOGGER.error("rpi5-ws2812 library not found. Install with 'pip install rpi5-ws2812'")
-            sys.exit(1)
-        except Exception as e:
-            _LOGGER.error(f"Error initializing RPI5-WS2812: {e}")
-            sys.exit(1)
-            
-    def set_color(self, led_index: int, r: int, g: int, b: int):
-        if 0 <= led_index < self.num_leds:
-            try:
-                self.led_states[led_index] = self.color_class(r, g, b)
-                self.strip.set_pixels(self.led_states)
-                self.strip.show()
-            except Exception as e:
-                _LOGGER.error(f"Error setting LED color: {e}")
-            
-    def set_all(self, r: int, g: int, b: int):
-        try:
-            self.led_states = [self.color_class(r, g, b)] * self.num_leds
-            self.strip.set_all_pixels(self.color_class(r, g, b))
-            self.strip.show()
-        except Exception as e:
-            _LOGGER.error(f"Error setting all LEDs: {e}")
-            
-    def cleanup(self):
-        """Clean up resources."""
-        try:
-            self.clear()
-            
-            # Properly close the SPI connection if on RPi5
-            if hasattr(self, 'strip') and hasattr(self.strip, '_spi'):
-                try:
-                    self.strip._spi.close()
-                    _LOGGER.info("SPI connection closed")
-                except Exception:
-                    pass
-        except Exception as e:
-            _LOGGER.error(f"Error during cleanup: {e}")
-
-class RPI281xLEDController(LEDController):
-    """LED Controller for other Raspberry Pi models using the rpi_ws281x library."""
-    
-    def __init__(self, num_leds: int, led_pin: int = 18):
-        super().__init__(num_leds)
-        try:
-            from rpi_ws281x import Color, PixelStrip, WS2811_STRIP_GRB
-            self.color_class = Color
-            LED_PIN = led_pin
-            LED_FREQ_HZ = 800000
-            LED_DMA = 10
-            LED_BRIGHTNESS = 255
-            LED_INVERT = False
-            LED_CHANNEL = 0
-
-            self.strip = PixelStrip(num_leds, LED_PIN, LED_FREQ_HZ, LED_DMA, LED_INVERT, 
-                                  LED_BRIGHTNESS, LED_CHANNEL, WS2811_STRIP_GRB)
-            self.strip.begin()
-            _LOGGER.info("Using RPI_WS281x driver")
-        except ImportError:
-            _LOGGER.error("rpi_ws281x library not found. Install with 'pip install rpi_ws281x'")
-            sys.exit(1)
-        except Exception as e:
-            _LOGGER.error(f"Error initializing RPI_WS281x: {e}")
-            sys.exit(1)
-            
-    def set_color(self, led_index: int, r: int, g: int, b: int):
-        if 0 <= led_index < self.num_leds:
-            try:
-                self.strip.setPixelColor(led_index, self.color_class(r, g, b))
-                self.strip.show()
-            except Exception as e:
-                _LOGGER.error(f"Error setting LED color: {e}")
+# Sequential ids for connected clients, only used in debug logs
+_CLIENT_IDS = itertools.count()
 
-class RespeakerLEDController(LEDController):
-    """LED Controller for ReSpeaker 2mic HAT using APA102."""
-    
-    # RGB mappings
-    RGB_MAP = {
-        "rgb": [3, 2, 1],
-        "rbg": [3, 1, 2],
-        "grb": [2, 3, 1],
-        "gbr": [2, 1, 3],
-        "brg": [1, 3, 2],
-        "bgr": [1, 2, 3],
-    }
-    
-    # APA102 constants
-    MAX_BRIGHTNESS = 0b11111
-    LED_START = 0b11100000
-    
-    def __init__(self, num_leds: int, gpio_pin: int = 12, brightness: int = 31, 
-                 order: str = "rgb", bus: int = None, device: int = 0, max_speed_hz: int = 8000000):
-        super().__init__(num_leds)
-        
-        # Set up GPIO for LED power
-        if gpiozero:
-            self.led_power = gpiozero.LED(gpio_pin, active_high=False)
-            self.led_power.on()
-        else:
-            _LOGGER.warning("gpiozero not available, LED power control disabled")
-            self.led_power = None
-            
-        # Set up RGB order
-        order = order.lower()
-        self.rgb = self.RGB_MAP.get(order, self.RGB_MAP["rgb"])
-        
-        # Set brightness
-        if brightness > self.MAX_BRIGHTNESS:
-            self.brightness = self.MAX_BRIGHTNESS
-        else:
-            self.brightness = brightness
-            
-        _LOGGER.debug("LED brightness: %d", self.brightness)
-        
-        # Initialize pixel buffer
-        self.leds = [self.LED_START, 0, 0, 0] * self.num_leds
-        
+class LEDWriter:
+    """Applies LED colors on a background thread so SPI writes never block the event loop."""
+
+    def __init__(self, led_controller: LEDController):
+        self.controller = led_controller
+        # Single slot: a color that hasn't been written yet is replaced by a newer one
+        self.pending: queue.Queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._run, name="led-writer", daemon=True)
+        self.thread.start()
+
+    def color(self, rgb: Optional[Tuple[int, int, int]]) -> None:
+        """Queue a color for all LEDs, dropping any color still waiting."""
+        # Only the event loop thread puts, so the slot is free after this
         try:
-            # Close any existing SPI connections first
-            import spidev
-            
-            # Determine which SPI bus to use - default is SPI1 for ReSpeaker
-            if bus is None:
-                # For ReSpeaker, traditionally use SPI1 on older Pis
-                # But on Pi5 with NVME, try to avoid conflicts
-                self.spi_bus = get_available_spi_bus()
-                if self.spi_bus is None:
-                    raise ValueError("No SPI bus available")
-            else:
-                self.spi_bus = bus
-                
-            _LOGGER.info(f"Using SPI bus {self.spi_bus} for ReSpeaker")
-            
+            self.pending.get_nowait()
+        except queue.Empty:
+            pass
+        self.pending.put_nowait(rgb)
+
+    def stop(self) -> None:
+        """Stop the writer thread once it finishes the current write."""
+        if self.thread.is_alive():
+            self.color(None)
+            self.thread.join()
+
+    def _run(self) -> None:
+        while True:
+            rgb = self.pending.get()
+            if rgb is None:
+                break
             try:
-                # Check if there's an existing connection to close
-                temp_spi = spidev.SpiDev()
-                temp_spi.open(self.spi_bus, device)
-                temp_spi.close()
-            except Exception:
-                # If no existing connection, this is fine
-                pass
-                
-            # Now open our connection
-            self.spi = spidev.SpiDev()
-            self.spi.open(self.spi_bus, device)
-            if max_speed_hz:
-                self.spi.max_speed_hz = max_speed_hz
-            _LOGGER.info("Using APA102 driver for ReSpeaker HAT")
-        except ImportError:
-            _LOGGER.error("spidev library not found. Install with 'pip install spidev'")
-            sys.exit(1)
-        except Exception as e:
-            _LOGGER.error(f"Error initializing SPI for ReSpeaker: {e}")
-            sys.exit(1)
-            
-    def set_color(self, led_num: int, r: int, g: int, b: int, bright_percent: int = 100):
-        """Set a single LED to a specific color."""
-        if led_num < 0 or led_num >= self.num_leds:
-            return
-            
-        # Calculate brightness
-        brightness = int((bright_percent * self.brightness / 100.0) + 0.5)
-        
-        # LED startframe is three "1" bits, followed by 5 brightness bits
-        ledstart = (brightness & 0b00011111) | self.LED_START
-        
-        start_index = 4 * led_num
-        self.leds[start_index] = ledstart
-        self.leds[start_index + self.rgb[0]] = r
-        self.leds[start_index + self.rgb[1]] = g
-        self.leds[start_index + self.rgb[2]] = b
-            
-    def show(self):
-        """Send the LED data to the strip."""
-        try:
-            self._clock_start_frame()
-            data = list(self.leds)
-            while data:
-                self.spi.xfer2(data[:32])
-                data = data[32:]
-            self._clock_end_frame()
-        except Exception as e:
-            _LOGGER.error(f"Error showing LEDs: {e}")
-        
-    def _clock_start_frame(self):
-        """Send start frame to the LED strip."""
-        self.spi.xfer2([0] * 4)
-        
-    def _clock_end_frame(self):
-        """Send end frame to the LED strip."""
-        self.spi.xfer2([0xFF] * 4)
-        
-    def set_all(self, r: int, g: int, b: int):
-        """Set all LEDs to the same color."""
-        for i in range(self.num_leds):
-            self.set_color(i, r, g, b)
-        self.show()
-        
-    def cleanup(self):
-        """Clean up resources."""
-        try:
-            self.clear()
-            if self.led_power:
-                self.led_power.off()
-            if hasattr(self, 'spi'):
-                self.spi.close()
-                _LOGGER.info("SPI connection closed")
-        except Exception as e:
-            _LOGGER.error(f"Error during cleanup: {e}")
-
-def create_led_controller(num_leds: int, gpio_pin: int = 12, brightness: int = 31,
-                         respeaker_mode: bool = False, led_pin: int = 18, 
-                         spi_bus: Optional[int] = None) -> LEDController:
-    """Factory method to create the appropriate LED controller."""
-    
-    if respeaker_mode:
-        _LOGGER.info("Using ReSpeaker HAT LED controller")
-        return RespeakerLEDController(num_leds, gpio_pin, brightness, bus=spi_bus)
-    
-    if is_raspberry_pi_5() and is_spi_enabled():
-        _LOGGER.info("Detected Raspberry Pi 5 with SPI enabled")
-        return RPI5LEDController(num_leds, spi_bus=spi_bus)
-    
-    _LOGGER.info("Using standard WS281x LED controller")
-    return RPI281xLEDController(num_leds, led_pin)
+                self.controller.set_prebuilt(rgb)
+            except Exception as e:
+                _LOGGER.error(f"Error writing LEDs: {e}")
 
 class LEDEventHandler(AsyncEventHandler):
     """Wyoming event handler for controlling LEDs."""
 
     def __init__(
         self,
-        led_controller: LEDController,
+        led_writer: LEDWriter,
         *args,
         **kwargs,
     ) -> None:
         super().__init__(*args, **kwargs)
         
-        self.client_id = str(time.monotonic_ns())
-        self.controller = led_controller
+        self.client_id = next(_CLIENT_IDS)
+        self.led_writer = led_writer
         
-        _LOGGER.debug("Client connected: %s", self.client_id)
+        # A color shown with a hold stays up until this loop time; colors
+        # requested meanwhile are deferred and shown in order afterwards
+        self._hold_until = 0.0
+        self._deferred: List[Tuple[Callable[[], None], float]] = []
+        self._deferred_handle: Optional[asyncio.TimerHandle] = None
+        self._flash_task: Optional[asyncio.Task] = None
+        
+        _LOGGER.debug("Client connected: %d", self.client_id)
 
     async def handle_event(self, event: Event) -> bool:
-        _LOGGER.debug(event)
-
-        if StreamingStarted.is_type(event.type):
-            self.color(_YELLOW)
-        elif Detection.is_type(event.type):
-            self.color(_BLUE)
-            await asyncio.sleep(1.0)  # show for 1 sec
-        elif VoiceStarted.is_type(event.type):
-            self.color(_YELLOW)
-        elif Transcript.is_type(event.type):
-            self.color(_GREEN)
-            await asyncio.sleep(1.0)  # show for 1 sec
-        elif StreamingStopped.is_type(event.type):
-            self.color(_BLACK)
-        elif RunSatellite.is_type(event.type):
-            self.color(_BLACK)
-        elif SatelliteConnected.is_type(event.type):
-            # Flash
-            for _ in range(3):
-                self.color(_GREEN)
-                await asyncio.sleep(0.3)
-                self.color(_BLACK)
-                await asyncio.sleep(0.3)
-        elif SatelliteDisconnected.is_type(event.type):
-            self.color(_RED)
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            _LOGGER.debug(event)
+
+        handler = _EVENT_HANDLERS.get(event.type)
+        if handler is not None:
+            handler(self)
 
         return True
 
-    def color(self, rgb: Tuple[int, int, int]) -> None:
-        """Set all LEDs to the same color."""
-        self.controller.set_all(rgb[0], rgb[1], rgb[2])
+    def color(self, rgb: Tuple[int, int, int], hold: float = 0.0) -> None:
+        """Set all LEDs to the same color, keeping it for at least hold seconds."""
+        self._show(partial(self.led_writer.color, rgb), hold)
+
+    def flash(self, rgb: Tuple[int, int, int], times: int, interval: float) -> None:
+        """Flash a color in the background, holding other colors until it is done."""
+        self._show(partial(self._start_flash, rgb, times, interval), 2 * times * interval)
+
+    def _show(self, show: Callable[[], None], hold: float) -> None:
+        """Run show() now, or after the current hold and anything already deferred."""
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        # Waiting entries go first even once the hold is over, as the timer
+        # showing them may not have run yet
+        if now < self._hold_until or self._deferred or self._deferred_handle is not None:
+            # A deferred color without a hold would be replaced immediately
+            while self._deferred and self._deferred[-1][1] == 0:
+                self._deferred.pop()
+            self._deferred.append((show, hold))
+            if self._deferred_handle is None:
+                self._deferred_handle = loop.call_at(self._hold_until, self._show_deferred)
+            return
+
+        show()
+        self._hold_until = now + hold
+
+    def _start_flash(self, rgb: Tuple[int, int, int], times: int, interval: float) -> None:
+        if self._flash_task is not None:
+            self._flash_task.cancel()
+        self._flash_task = asyncio.create_task(self._flash(rgb, times, interval))
+
+    async def _flash(self, rgb: Tuple[int, int, int], times: int, interval: float) -> None:
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for step in range(2 * times):
+            self.led_writer.color(rgb if step % 2 == 0 else _BLACK)
+            # Sleep until the next slot of a fixed schedule so delays don't add up
+            await asyncio.sleep(max(0.0, start + (step + 1) * interval - loop.time()))
+
+    def _show_deferred(self) -> None:
+        self._deferred_handle = None
+        loop = asyncio.get_running_loop()
+        if self._deferred:
+            # Shown directly: the timer may fire a hair before _hold_until
+            show, hold = self._deferred.pop(0)
+            show()
+            self._hold_until = max(self._hold_until, loop.time()) + hold
+        if self._deferred:
+            self._deferred_handle = loop.call_at(self._hold_until, self._show_deferred)
+
+# LED reaction per Wyoming event type, so each event costs one dict lookup.
+# The type strings come from the event classes, as wyoming keeps them private.
+_EVENT_HANDLERS: Dict[str, Callable[[LEDEventHandler], None]] = {
+    StreamingStarted().event().type: lambda handler: handler.color(_YELLOW),
+    Detection().event().type: lambda handler: handler.color(_BLUE, hold=1.0),  # show for 1 sec
+    VoiceStarted().event().type: lambda handler: handler.color(_YELLOW),
+    Transcript(text="").event().type: lambda handler: handler.color(_GREEN, hold=1.0),  # show for 1 sec
+    StreamingStopped().event().type: lambda handler: handler.color(_BLACK),
+    RunSatellite().event().type: lambda handler: handler.color(_BLACK),
+    SatelliteConnected().event().type: lambda handler: handler.flash(_GREEN, times=3, interval=0.3),
+    SatelliteDisconnected().event().type: lambda handler: handler.color(_RED),
+}
 
 async def main() -> None:
     """Main entry point."""
@@ -443,6 +216,12 @@ async def main() -> None:
         choices=[0, 1, 10],
         help="SPI bus to use (0, 1, or 10, default: auto-detect, try SPI10/SPI1 first to avoid NVME conflicts)",
     )
+    parser.add_argument(
+        "--spi-hz",
+        type=int,
+        default=APA102_SPI_HZ,
+        help=f"SPI clock for the ReSpeaker HAT LEDs in Hz (default: {APA102_SPI_HZ})",
+    )
     
     args = parser.parse_args()
 
@@ -456,29 +235,39 @@ async def main() -> None:
         brightness=args.led_brightness,
         respeaker_mode=args.respeaker,
         led_pin=args.led_pin,
-        spi_bus=args.spi_bus
+        spi_bus=args.spi_bus,
+        spi_hz=args.spi_hz
     )
+    led_controller.prebuild(_PALETTE)
+    led_writer = LEDWriter(led_controller)
     
-    # Signal handler for graceful shutdown
-    def signal_handler(sig, frame):
-        _LOGGER.info("Shutting down...")
-        led_controller.cleanup()
-        sys.exit(0)
-        
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
-
     _LOGGER.info("LED service ready")
 
     # Start server
     server = AsyncServer.from_uri(args.uri)
+    server_task = asyncio.create_task(server.run(partial(LEDEventHandler, led_writer)))
+
+    # Signals only set an event, so shutdown runs on the event loop after
+    # the writer thread has finished its current write
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
 
+    stop_task = asyncio.create_task(stop_event.wait())
     try:
-        await server.run(partial(LEDEventHandler, led_controller))
-    except KeyboardInterrupt:
-        pass
+        await asyncio.wait({server_task, stop_task}, return_when=asyncio.FIRST_COMPLETED)
+        if server_task.done():
+            # The server only returns by failing, e.g. when the port is taken
+            server_task.result()
+        _LOGGER.info("Shutting down...")
     finally:
+        led_writer.stop()
         led_controller.cleanup()
+        # Not awaited: closing the server waits for connected satellites to
+        # hang up on Python 3.12+
+        server_task.cancel()
+        stop_task.cancel()
 
 if __name__ == "__main__":
     try: